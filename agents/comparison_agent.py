@@ -1,46 +1,100 @@
+from collections import OrderedDict
 from uuid import uuid4
-from typing import List, Optional
-import json
+from typing import Callable, List, Optional
+import asyncio
+import hashlib
+import logging
+import math
+import orjson
+import time
+from cachetools import TTLCache
 from openai import AsyncOpenAI
 
+from config import API_KEY, BASE_URL, EMBEDDING_MODEL, MODEL
 from models.a2a import (
     A2AMessage, TaskResult, TaskStatus, Artifact,
     MessagePart, MessageConfiguration
 )
 from utils.utils import (
-    compare_companies, handle_tool_calls, 
-    is_comparison_query, tools
+    clean_html, compare_companies, explicit_ticker_pair, extract_tickers, handle_tool_calls,
+    is_comparison_query, tools, warm_up_session
 )
-from utils.data import system_prompt
-import os
-from dotenv import load_dotenv
+from utils.data import non_comparison_message, system_prompt
 
-load_dotenv()
+logger = logging.getLogger(__name__)
+
+# Static prompt prefix shared by every request. Keeping it byte-identical and
+# first in the message list (followed by the module-level tools schema) lets
+# the provider serve it from its prompt cache instead of re-running prefill.
+SYSTEM_MESSAGE = {"role": "system", "content": system_prompt}
+
+# Number of user/assistant exchanges of history sent with each request
+HISTORY_WINDOW = 6
+
+# Conversations idle for longer than this are forgotten
+CONVERSATION_TTL = 3600  # seconds
+CONVERSATION_MAXSIZE = 10_000
+
+# Exact response cache keyed by the normalized query text and model
+EXACT_CACHE_TTL = 900  # seconds
+EXACT_CACHE_MAXSIZE = 512
+
+# Seconds each startup warm-up may take; the Yahoo one covers the cookie and
+# crumb round trips as well as the quote itself
+WARM_UP_TIMEOUT = 5
+
+# Semantic response cache: reuse a previous answer for the same ticker pair
+# when the new query's embedding is close enough to the cached one
+SEMANTIC_CACHE_TTL = 900  # seconds, prices move so answers go stale
+SEMANTIC_CACHE_THRESHOLD = 0.92
+SEMANTIC_CACHE_MAXSIZE = 256
+
+
+def _cosine_similarity(a: list[float], b: list[float]) -> float:
+    dot = sum(x * y for x, y in zip(a, b))
+    norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+    return dot / norm if norm else 0.0
 
 
 class ComparisonAgent:
-    def __init__(self, openai_api_key: str, model: str = "gpt-4o-mini"):
-        self.client = AsyncOpenAI(api_key=os.getenv("GOOGLE_API_KEY"),
-                                  base_url=os.getenv("BASE_URL"))
-        self.model = os.getenv('MODEL')
-        self.conversations = {}  # Store conversation history by context_id
+    def __init__(self, openai_api_key: Optional[str] = None, model: Optional[str] = None):
+        # Explicit arguments override the configured defaults
+        self.client = AsyncOpenAI(api_key=openai_api_key or API_KEY,
+                                  base_url=BASE_URL)
+        self.model = model or MODEL
+        # Store conversations by context_id as prebuilt prompts (system message
+        # + history window), extended in place each turn instead of being rebuilt
+        self.conversations = TTLCache(maxsize=CONVERSATION_MAXSIZE, ttl=CONVERSATION_TTL)
+
+        # Entries: {key: (response, comparison_data, created_at)}, oldest first
+        self._exact_cache = OrderedDict()
+
+        # Pipelines currently running, by cache key, so identical concurrent
+        # requests share one LLM + tool chain instead of each starting their own
+        self._inflight: dict[bytes, asyncio.Future] = {}
+
+        # Semantic cache is only enabled when an embedding model is configured
+        self.embedding_model = EMBEDDING_MODEL
+        # Entries: (embedding, ticker_pair, response, comparison_data, created_at)
+        self._sem_cache = []
 
     async def process_messages(
         self,
         messages: List[A2AMessage],
         context_id: Optional[str] = None,
         task_id: Optional[str] = None,
-        config: Optional[MessageConfiguration] = None
+        config: Optional[MessageConfiguration] = None,
+        on_delta: Optional[Callable[[str], None]] = None
     ) -> TaskResult:
-        """Process incoming messages and generate company comparisons"""
+        """
+        Process incoming messages and generate company comparisons.
+        If on_delta is given, response text is passed to it as it streams in.
+        """
         
         # Generate IDs if not provided
         context_id = context_id or str(uuid4())
         task_id = task_id or str(uuid4())
         
-        # Get or create conversation history for this context
-        history = self.conversations.get(context_id, [])
-        
         # Extract last user message
         user_message = messages[-1] if messages else None
         if not user_message:
@@ -52,57 +106,73 @@ class ComparisonAgent:
         if not user_text:
             raise ValueError("No text content found in message")
         
-        # Merge message history with stored history
-        # Message history takes precedence (it's the most recent context)
-        if message_history:
-            history = message_history
-        
         # Clean HTML from current user text
-        user_text = self._clean_html(user_text)
+        user_text = clean_html(user_text)
         
         # Check if it's a comparison query
         if not is_comparison_query(user_text):
-            error_msg = (
-                "This AI Agent is designed only for comparing two companies.\n\n"
-                "Example inputs:\n"
-                "- Compare Apple and Microsoft\n"
-                "- How does Tesla compare to Ford?\n"
-                "- Which is better, Google or Amazon?\n\n"
-                "Please rephrase your request to include two companies for comparison."
-            )
-            
-            response_message = A2AMessage(
-                role="agent",
-                parts=[MessagePart(kind="text", text=error_msg)],
-                taskId=task_id
-            )
-            
-            return TaskResult(
-                id=task_id,
-                contextId=context_id,
-                status=TaskStatus(
-                    state="completed",
-                    message=response_message
-                ),
-                artifacts=[],
-                history=messages + [response_message]
+            return self._build_result(
+                messages, task_id, context_id, "completed", non_comparison_message
             )
         
         # Process with OpenAI and tools
         try:
-            assistant_response, comparison_data = await self._chat_with_tools(
-                user_text, 
-                history
-            )
+            # Message history takes precedence over the stored conversation
+            # (it's the most recent context)
+            prefix = self._prefix_for(context_id, message_history)
             
-            # Update conversation history
-            self.conversations[context_id] = history
+            cache_key = self._cache_key(user_text, prefix)
+            cached = self._exact_lookup(cache_key)
+
+            sem_key = None
+            if cached is None:
+                sem_key = await self._semantic_key(user_text)
+                cached = self._semantic_lookup(sem_key) if sem_key else None
+                if cached:
+                    self._exact_store(cache_key, *cached)
+
+            if cached is None and cache_key in self._inflight:
+                # An identical request is already running, wait for its result
+                cached = await asyncio.shield(self._inflight[cache_key])
+
+            if cached:
+                assistant_response, comparison_data = cached
+            else:
+                inflight = asyncio.get_running_loop().create_future()
+                # Mark the exception as retrieved when nobody else awaited it
+                inflight.add_done_callback(lambda f: f.cancelled() or f.exception())
+                self._inflight[cache_key] = inflight
+
+                try:
+                    assistant_response, comparison_data = await self._chat_with_tools(
+                        user_text,
+                        prefix,
+                        on_delta
+                    )
+                except Exception as e:
+                    inflight.set_exception(e)
+                    raise
+                else:
+                    inflight.set_result((assistant_response, comparison_data))
+                finally:
+                    self._inflight.pop(cache_key, None)
+                    if not inflight.done():
+                        # This request was cancelled (e.g. a streaming client
+                        # disconnected). Fail the waiters with a normal error
+                        # rather than cancelling them too.
+                        inflight.set_exception(
+                            RuntimeError("The identical request this one was waiting on was cancelled")
+                        )
+
+                if comparison_data and "insight" in comparison_data:
+                    self._exact_store(cache_key, assistant_response, comparison_data)
+                    if sem_key:
+                        self._semantic_store(sem_key, assistant_response, comparison_data)
             
-            # Build response message
-            response_message = A2AMessage(
-                role="agent",
-                parts=[MessagePart(kind="text", text=assistant_response)],
-                taskId=task_id
+            # Update conversation history, keeping only the recent window
+            self._remember(
+                context_id, prefix, user_text, assistant_response,
+                replace=bool(message_history)
             )
             
             # Build artifacts
@@ -125,39 +195,40 @@ class ComparisonAgent:
                     )
                 )
             
-            # Build full history
-            full_history = messages + [response_message]
-            
-            return TaskResult(
-                id=task_id,
-                contextId=context_id,
-                status=TaskStatus(
-                    state="completed",
-                    message=response_message
-                ),
-                artifacts=artifacts,
-                history=full_history
+            return self._build_result(
+                messages, task_id, context_id, "completed", assistant_response, artifacts
             )
             
         except Exception as e:
             error_msg = f"An error occurred while processing your request: {str(e)}"
-            
-            response_message = A2AMessage(
-                role="agent",
-                parts=[MessagePart(kind="text", text=error_msg)],
-                taskId=task_id
-            )
-            
-            return TaskResult(
-                id=task_id,
-                contextId=context_id,
-                status=TaskStatus(
-                    state="failed",
-                    message=response_message
-                ),
-                artifacts=[],
-                history=messages + [response_message]
-            )
+            return self._build_result(messages, task_id, context_id, "failed", error_msg)
+
+    def _build_result(
+        self,
+        messages: list,
+        task_id: str,
+        context_id: str,
+        state: str,
+        text: str,
+        artifacts: Optional[List[Artifact]] = None
+    ) -> TaskResult:
+        """Build the TaskResult for an agent reply, appending the reply to the history"""
+        response_message = A2AMessage(
+            role="agent",
+            parts=[MessagePart(kind="text", text=text)],
+            taskId=task_id
+        )
+        
+        return TaskResult(
+            id=task_id,
+            contextId=context_id,
+            status=TaskStatus(
+                state=state,
+                message=response_message
+            ),
+            artifacts=artifacts or [],
+            history=messages + [response_message]
+        )
 
     def _extract_conversation_history(self, message: A2AMessage) -> tuple[str, list]:
         """
@@ -185,7 +256,7 @@ class ComparisonAgent:
                                 continue
                             
                             # Clean HTML tags from text
-                            cleaned_text = self._clean_html(text)
+                            cleaned_text = clean_html(text)
                             
                             # Determine role based on content patterns
                             # Agent messages are typically longer explanations/responses
@@ -208,90 +279,283 @@ class ComparisonAgent:
         
         return latest_text, history
     
-    def _clean_html(self, text: str) -> str:
-        """Remove HTML tags from text"""
-        import re
-        # Remove HTML tags
-        clean = re.sub(r'<[^>]+>', '', text)
-        # Remove extra whitespace
-        clean = ' '.join(clean.split())
-        return clean.strip()
-
-    async def _chat_with_tools(self, message: str, history: list) -> tuple[str, dict]:
+    async def _chat_with_tools(
+        self,
+        message: str,
+        prefix: list,
+        on_delta: Optional[Callable[[str], None]] = None
+    ) -> tuple[str, dict]:
         """
         Chat with OpenAI using tools for company comparison.
         
         Args:
             message: The current user message
-            history: Conversation history as list of {"role": "user"/"assistant", "content": "..."}
+            prefix: Prebuilt prompt from _prefix_for (system message + history).
+                    Not modified.
+            on_delta: Optional callback receiving response text as it streams in
         
         Returns:
             tuple: (assistant_response, comparison_data)
         """
-        # Build messages array starting with system prompt
-        messages = [{"role": "system", "content": system_prompt}]
+        # Work on a copy so concurrent turns on the same context don't interleave;
+        # only _remember updates the cached prefix
+        messages = [*prefix, {"role": "user", "content": message}]
         
-        # Add conversation history (already in correct format)
-        messages.extend(history)
+        comparison_data = None
         
-        # Add current user message
-        messages.append({"role": "user", "content": message})
+        # Fast path: the message is just a comparison of two ticker symbols,
+        # so fetch the data ourselves and skip the tool-call round trip
+        tickers = explicit_ticker_pair(message)
+        if tickers:
+            data = await compare_companies(*tickers)
+            if "insight" in data:
+                messages.append({
+                    "role": "system",
+                    "content": (
+                        f"compare_companies({tickers[0]!r}, {tickers[1]!r}) returned:\n"
+                        f"{orjson.dumps(data).decode()}"
+                    )
+                })
+                text, _ = await self._stream_completion(messages, on_delta, use_tools=False)
+                return text, data
         
-        comparison_data = None
-        done = False
+        while True:
+            text, tool_calls = await self._stream_completion(messages, on_delta)
+            
+            if not tool_calls:
+                return text, comparison_data
+            
+            tool_messages, results = await handle_tool_calls(tool_calls)
+            
+            # Extract comparison data from tool results
+            for result in results:
+                if "insight" in result or "company1" in result:
+                    comparison_data = result
+            
+            messages.append({
+                "role": "assistant",
+                "content": text or None,
+                "tool_calls": tool_calls
+            })
+            messages.extend(tool_messages)
+
+    def _prefix_for(self, context_id: str, message_history: list) -> list:
+        """
+        Get the prompt prefix for a turn: the stored conversation, or one built
+        from the message history when the request carries its own. Nothing is
+        stored until the turn completes (see _remember).
+        """
+        if message_history:
+            # Start with the cacheable system prompt, then the recent history
+            # (already in correct format)
+            return [SYSTEM_MESSAGE, *message_history[-2 * HISTORY_WINDOW:]]
         
-        while not done:
-            response = await self.client.chat.completions.create(
-                model=self.model,
-                messages=messages,
-                tools=tools
-            )
+        return self.conversations.get(context_id) or [SYSTEM_MESSAGE]
+
+    def _remember(
+        self,
+        context_id: str,
+        prefix: list,
+        user_text: str,
+        response: str,
+        replace: bool = False
+    ) -> None:
+        """
+        Record a completed exchange in the stored conversation, keeping the
+        recent window. The exchange is added to whatever is stored now, so
+        concurrent turns on a context all land in it; with replace=True the
+        conversation restarts from this turn's prefix instead.
+        """
+        conversation = self.conversations.get(context_id)
+        if conversation is None or replace:
+            conversation = prefix
+        
+        conversation.extend([
+            {"role": "user", "content": user_text},
+            {"role": "assistant", "content": response}
+        ])
+        # Keep the system message plus the last HISTORY_WINDOW exchanges
+        del conversation[1:-2 * HISTORY_WINDOW]
+        # Reassign so the cache entry's TTL restarts
+        self.conversations[context_id] = conversation
+
+    async def _stream_completion(
+        self,
+        messages: list,
+        on_delta: Optional[Callable[[str], None]] = None,
+        use_tools: bool = True
+    ) -> tuple[str, list]:
+        """
+        Run one streamed completion, forwarding text deltas to on_delta.
+        If use_tools is False the model is called without the tools schema.
+        
+        Text sent alongside tool calls never reaches the final answer, so when
+        tools are enabled the round's text is held back and only passed to
+        on_delta once the round ends without tool calls.
+        
+        Returns:
+            tuple: (content, tool_calls)
+                   tool_calls is a list of assistant tool_call dicts, empty if none
+        """
+        kwargs = {"tools": tools} if use_tools else {}
+        stream = await self.client.chat.completions.create(
+            model=self.model,
+            messages=messages,
+            stream=True,
+            # Usage (including cached prompt tokens) only arrives in a stream when requested
+            stream_options={"include_usage": True},
+            **kwargs
+        )
+        
+        content_parts = []
+        tool_calls = {}  # Partial tool calls by stream index
+        # Without tools this round is always the final answer
+        stream_live = on_delta is not None and not use_tools
+        
+        async for chunk in stream:
+            self._log_cache_usage(chunk)
+            if not chunk.choices:
+                continue
             
-            choice = response.choices[0]
-            finish_reason = choice.finish_reason
+            delta = chunk.choices[0].delta
             
-            if finish_reason == 'tool_calls':
-                message_obj = choice.message
-                tool_calls = message_obj.tool_calls
-                results = handle_tool_calls(tool_calls)
-                
-                # Extract comparison data from tool results
-                for result in results:
-                    content = json.loads(result["content"])
-                    if "insight" in content or "company1" in content:
-                        comparison_data = content
-                
-                # Convert message_obj to dict for messages list
-                messages.append({
-                    "role": "assistant",
-                    "content": message_obj.content,
-                    "tool_calls": [
-                        {
-                            "id": tc.id,
-                            "type": tc.type,
-                            "function": {
-                                "name": tc.function.name,
-                                "arguments": tc.function.arguments
-                            }
-                        }
-                        for tc in tool_calls
-                    ]
-                })
-                messages.extend(results)
-            else:
-                done = True
-                assistant_message = choice.message
-                
-                # Update history
-                history.append({"role": "user", "content": message})
-                history.append({
-                    "role": "assistant", 
-                    "content": assistant_message.content
+            if delta.content:
+                content_parts.append(delta.content)
+                if stream_live:
+                    on_delta(delta.content)
+            
+            # Tool call names and arguments arrive in fragments
+            for tc in delta.tool_calls or []:
+                index = tc.index if tc.index is not None else len(tool_calls)
+                call = tool_calls.setdefault(index, {
+                    "id": None,
+                    "type": "function",
+                    "function": {"name": "", "arguments": ""}
                 })
-                
-                return assistant_message.content, comparison_data
+                if tc.id:
+                    call["id"] = tc.id
+                if tc.function and tc.function.name:
+                    call["function"]["name"] += tc.function.name
+                if tc.function and tc.function.arguments:
+                    call["function"]["arguments"] += tc.function.arguments
+        
+        content = "".join(content_parts)
+        if on_delta and not stream_live and not tool_calls and content:
+            on_delta(content)
+        
+        return content, [tool_calls[i] for i in sorted(tool_calls)]
+
+    def _cache_key(self, text: str, prefix: list) -> bytes:
+        """
+        Hash of the model, the conversation's history window and the normalized
+        query, used by the exact response cache and single-flight coalescing.
+        Including the history keeps follow-ups such as "which one is better?"
+        from sharing answers across conversations.
+        """
+        normalized = orjson.dumps([self.model, prefix[1:], text.lower().strip()])
+        return hashlib.blake2b(normalized, digest_size=16).digest()
+
+    def _exact_lookup(self, key: bytes) -> Optional[tuple[str, dict]]:
+        """Return a cached (response, comparison_data) for an identical recent query"""
+        entry = self._exact_cache.get(key)
+        if entry is None:
+            return None
+
+        response, data, created_at = entry
+        if time.monotonic() - created_at >= EXACT_CACHE_TTL:
+            del self._exact_cache[key]
+            return None
+
+        self._exact_cache.move_to_end(key)
+        return response, data
+
+    def _exact_store(self, key: bytes, response: str, data: dict) -> None:
+        self._exact_cache[key] = (response, data, time.monotonic())
+        self._exact_cache.move_to_end(key)
+        if len(self._exact_cache) > EXACT_CACHE_MAXSIZE:
+            self._exact_cache.popitem(last=False)
+
+    async def _semantic_key(self, text: str) -> Optional[tuple[list[float], tuple[str, str]]]:
+        """
+        Build the semantic cache key for a query: its embedding plus the ticker pair.
+        Returns None when the cache is disabled, the query does not name exactly
+        two tickers, or the embedding call fails.
+        """
+        if not self.embedding_model:
+            return None
+
+        tickers = extract_tickers(text)
+        if len(tickers) != 2:
+            return None
+
+        try:
+            response = await self.client.embeddings.create(
+                model=self.embedding_model,
+                input=text.lower().strip()
+            )
+        except Exception as e:
+            logger.warning("embedding request failed, skipping semantic cache: %s", e)
+            return None
+
+        return response.data[0].embedding, tuple(sorted(tickers))
+
+    def _semantic_lookup(self, key: tuple[list[float], tuple[str, str]]) -> Optional[tuple[str, dict]]:
+        """Return a cached (response, comparison_data) for a similar query on the same tickers"""
+        embedding, ticker_pair = key
+        now = time.monotonic()
+
+        # Drop expired entries before scanning
+        self._sem_cache = [
+            entry for entry in self._sem_cache
+            if now - entry[4] < SEMANTIC_CACHE_TTL
+        ]
+
+        for cached_embedding, cached_pair, response, data, _ in self._sem_cache:
+            if cached_pair != ticker_pair:
+                continue
+            if _cosine_similarity(embedding, cached_embedding) >= SEMANTIC_CACHE_THRESHOLD:
+                return response, data
+
+        return None
+
+    def _semantic_store(self, key: tuple[list[float], tuple[str, str]], response: str, data: dict) -> None:
+        embedding, ticker_pair = key
+        self._sem_cache.append((embedding, ticker_pair, response, data, time.monotonic()))
+        if len(self._sem_cache) > SEMANTIC_CACHE_MAXSIZE:
+            self._sem_cache.pop(0)
+
+    def _log_cache_usage(self, response) -> None:
+        """Log how many prompt tokens the provider served from its prompt cache"""
+        usage = getattr(response, "usage", None)
+        details = getattr(usage, "prompt_tokens_details", None) if usage else None
+        if details is not None:
+            logger.debug(
+                "prompt tokens: %s, cached: %s",
+                usage.prompt_tokens,
+                getattr(details, "cached_tokens", 0)
+            )
+
+    async def warm_up(self):
+        """
+        Open connections to the LLM endpoint and Yahoo Finance ahead of the
+        first request, including Yahoo's cookie/crumb handshake. Each one is
+        abandoned after WARM_UP_TIMEOUT seconds without retrying, so a slow
+        endpoint cannot hold up startup. Failures are logged and otherwise
+        ignored.
+        """
+        client = self.client.with_options(timeout=WARM_UP_TIMEOUT, max_retries=0)
+        results = await asyncio.gather(
+            client.models.list(),
+            asyncio.wait_for(asyncio.to_thread(warm_up_session), WARM_UP_TIMEOUT),
+            return_exceptions=True
+        )
+        for result in results:
+            if isinstance(result, Exception):
+                logger.warning("warm-up request failed: %r", result)
 
     async def cleanup(self):
         """Cleanup resources"""
         self.conversations.clear()
+        self._exact_cache.clear()
+        self._sem_cache.clear()
         await self.client.close()
\ No newline at end of file
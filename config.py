@@ -0,0 +1,15 @@
+from typing import Final, Optional
+from dotenv import load_dotenv
+import os
+
+# Read .env and the environment once at import; everything else imports these
+load_dotenv()
+
+API_KEY: Final[str] = os.environ["GOOGLE_API_KEY"]
+BASE_URL: Final[str] = os.environ["BASE_URL"]
+MODEL: Final[str] = os.environ["MODEL"]
+
+# Optional: enables the semantic response cache when set
+EMBEDDING_MODEL: Final[Optional[str]] = os.getenv("EMBEDDING_MODEL")
+
+PORT: Final[int] = int(os.getenv("PORT", 5001))
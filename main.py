@@ -1,14 +1,15 @@
 from fastapi import FastAPI, Request
-from fastapi.responses import JSONResponse
+from fastapi.responses import Response, StreamingResponse
 from contextlib import asynccontextmanager
-from dotenv import load_dotenv
-import os
+from uuid import uuid4
+import asyncio
+import msgspec
+import orjson
 
-from models.a2a import JSONRPCRequest, JSONRPCResponse
+from config import PORT
+from models.a2a import JSONRPCRequest, JSONRPCResponse, MessageSendRequest, encoder
 from agents.comparison_agent import ComparisonAgent
 
-load_dotenv()
-
 # Initialize comparison agent
 comparison_agent = None
 
@@ -19,10 +20,8 @@ async def lifespan(app: FastAPI):
     global comparison_agent
     
     # Startup: Initialize the comparison agent
-    comparison_agent = ComparisonAgent(
-        openai_api_key=os.getenv("OPENAI_API_KEY"),
-        model=os.getenv("OPENAI_MODEL", "gpt-4o-mini")
-    )
+    comparison_agent = ComparisonAgent()
+    await comparison_agent.warm_up()
     
     yield
     
@@ -39,6 +38,60 @@ app = FastAPI(
 )
 
 
+def _json_response(content, status_code: int = 200) -> Response:
+    """JSON response encoded with orjson"""
+    return Response(
+        content=orjson.dumps(content),
+        status_code=status_code,
+        media_type="application/json"
+    )
+
+
+def _invalid_request(body: dict):
+    """Return a JSON-RPC error response if the body is not a valid request"""
+    if body.get("jsonrpc") != "2.0" or "id" not in body:
+        return _json_response(
+            status_code=400,
+            content={
+                "jsonrpc": "2.0",
+                "id": body.get("id"),
+                "error": {
+                    "code": -32600,
+                    "message": "Invalid Request: jsonrpc must be '2.0' and id is required"
+                }
+            }
+        )
+    return None
+
+
+def _internal_error(body, e: Exception) -> dict:
+    return {
+        "jsonrpc": "2.0",
+        "id": body.get("id") if isinstance(body, dict) else None,
+        "error": {
+            "code": -32603,
+            "message": "Internal error",
+            "data": {"details": str(e)}
+        }
+    }
+
+
+def _sse(payload) -> str:
+    """Format a dict or pre-encoded JSON string as a server-sent event"""
+    if not isinstance(payload, str):
+        payload = orjson.dumps(payload).decode()
+    return f"data: {payload}\n\n"
+
+
+def _extract_params(rpc_request: JSONRPCRequest):
+    """Extract (messages, context_id, task_id, config) from a JSON-RPC request"""
+    if isinstance(rpc_request, MessageSendRequest):
+        return [rpc_request.params.message], None, None, rpc_request.params.configuration
+    
+    params = rpc_request.params
+    return params.messages, params.contextId, params.taskId, None
+
+
 @app.post("/a2a/compare")
 async def a2a_endpoint(request: Request):
     """Main A2A endpoint for company comparison agent"""
@@ -47,34 +100,15 @@ async def a2a_endpoint(request: Request):
         body = await request.json()
         
         # Validate JSON-RPC request
-        if body.get("jsonrpc") != "2.0" or "id" not in body:
-            return JSONResponse(
-                status_code=400,
-                content={
-                    "jsonrpc": "2.0",
-                    "id": body.get("id"),
-                    "error": {
-                        "code": -32600,
-                        "message": "Invalid Request: jsonrpc must be '2.0' and id is required"
-                    }
-                }
-            )
+        invalid = _invalid_request(body)
+        if invalid:
+            return invalid
         
-        rpc_request = JSONRPCRequest(**body)
+        # Validate the body against the A2A models (the method selects the params type)
+        rpc_request = msgspec.convert(body, JSONRPCRequest)
         
         # Extract messages
-        messages = []
-        context_id = None
-        task_id = None
-        config = None
-        
-        if rpc_request.method == "message/send":
-            messages = [rpc_request.params.message]
-            config = rpc_request.params.configuration
-        elif rpc_request.method == "execute":
-            messages = rpc_request.params.messages
-            context_id = rpc_request.params.contextId
-            task_id = rpc_request.params.taskId
+        messages, context_id, task_id, config = _extract_params(rpc_request)
         
         # Process with comparison agent
         result = await comparison_agent.process_messages(
@@ -90,23 +124,78 @@ async def a2a_endpoint(request: Request):
             result=result
         )
         
-        return response.model_dump()
+        return Response(content=encoder.encode(response), media_type="application/json")
         
     except Exception as e:
-        return JSONResponse(
+        return _json_response(
             status_code=500,
-            content={
-                "jsonrpc": "2.0",
-                "id": body.get("id") if "body" in locals() else None,
-                "error": {
-                    "code": -32603,
-                    "message": "Internal error",
-                    "data": {"details": str(e)}
-                }
-            }
+            content=_internal_error(body if "body" in locals() else None, e)
         )
 
 
+@app.post("/a2a/compare/stream")
+async def a2a_stream_endpoint(request: Request):
+    """
+    Streaming variant of the A2A endpoint. Sends server-sent events: a
+    "message/delta" notification per chunk of response text, then the final
+    JSON-RPC response.
+    """
+    try:
+        body = await request.json()
+        
+        invalid = _invalid_request(body)
+        if invalid:
+            return invalid
+        
+        rpc_request = msgspec.convert(body, JSONRPCRequest)
+        messages, context_id, task_id, config = _extract_params(rpc_request)
+    except Exception as e:
+        return _json_response(
+            status_code=500,
+            content=_internal_error(body if "body" in locals() else None, e)
+        )
+    
+    # Fix the IDs up front so delta notifications can reference them
+    context_id = context_id or str(uuid4())
+    task_id = task_id or str(uuid4())
+    
+    async def event_stream():
+        deltas = asyncio.Queue()
+        task = asyncio.create_task(comparison_agent.process_messages(
+            messages=messages,
+            context_id=context_id,
+            task_id=task_id,
+            config=config,
+            on_delta=deltas.put_nowait
+        ))
+        # None marks the end of the stream
+        task.add_done_callback(lambda _: deltas.put_nowait(None))
+        
+        try:
+            while (delta := await deltas.get()) is not None:
+                yield _sse({
+                    "jsonrpc": "2.0",
+                    "method": "message/delta",
+                    "params": {
+                        "taskId": task_id,
+                        "contextId": context_id,
+                        "text": delta
+                    }
+                })
+            
+            try:
+                response = JSONRPCResponse(id=rpc_request.id, result=await task)
+                yield _sse(encoder.encode(response).decode())
+            except Exception as e:
+                yield _sse(_internal_error(body, e))
+        finally:
+            # Client disconnected before the agent finished
+            if not task.done():
+                task.cancel()
+    
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
+
+
 @app.get("/health")
 async def health_check():
     """Health check endpoint"""
@@ -115,5 +204,4 @@ async def health_check():
 
 if __name__ == "__main__":
     import uvicorn
-    port = int(os.getenv("PORT", 5001))
-    uvicorn.run(app, host="0.0.0.0", port=port)
\ No newline at end of file
+    uvicorn.run(app, host="0.0.0.0", port=PORT)
\ No newline at end of file
@@ -1,79 +1,98 @@
-from pydantic import BaseModel, Field
+import msgspec
 from typing import Literal, Optional, List, Dict, Any, Union
 from datetime import datetime
 from uuid import uuid4
 
+# A2A request and response models. msgspec structs are much cheaper to build
+# and encode than pydantic models. Incoming requests are validated once, when
+# the decoded body is converted into these types with msgspec.convert.
 
-class MessagePart(BaseModel):
+
+class MessagePart(msgspec.Struct, kw_only=True):
     kind: Literal["text", "data", "file"]
     text: Optional[str] = None
     data: Optional[Union[Dict[str, Any], List[Any]]] = None  # Can be dict or list
     file_url: Optional[str] = None
 
 
-class A2AMessage(BaseModel):
+class A2AMessage(msgspec.Struct, kw_only=True):
     kind: Literal["message"] = "message"
     role: Literal["user", "agent", "system"]
     parts: List[MessagePart]
-    messageId: str = Field(default_factory=lambda: str(uuid4()))
+    messageId: str = msgspec.field(default_factory=lambda: str(uuid4()))
     taskId: Optional[str] = None
     metadata: Optional[Dict[str, Any]] = None
 
 
-class PushNotificationConfig(BaseModel):
+class PushNotificationConfig(msgspec.Struct, kw_only=True):
     url: str
     token: Optional[str] = None
     authentication: Optional[Dict[str, Any]] = None
 
 
-class MessageConfiguration(BaseModel):
+class MessageConfiguration(msgspec.Struct, kw_only=True):
     blocking: bool = True
-    acceptedOutputModes: List[str] = ["text/plain", "application/json"]
+    acceptedOutputModes: List[str] = msgspec.field(
+        default_factory=lambda: ["text/plain", "application/json"]
+    )
     pushNotificationConfig: Optional[PushNotificationConfig] = None
     historyLength: Optional[int] = 0
 
 
-class MessageParams(BaseModel):
+class MessageParams(msgspec.Struct, kw_only=True):
     message: A2AMessage
-    configuration: MessageConfiguration = Field(default_factory=MessageConfiguration)
+    configuration: MessageConfiguration = msgspec.field(default_factory=MessageConfiguration)
 
 
-class ExecuteParams(BaseModel):
+class ExecuteParams(msgspec.Struct, kw_only=True):
     contextId: Optional[str] = None
     taskId: Optional[str] = None
     messages: List[A2AMessage]
 
 
-class JSONRPCRequest(BaseModel):
+# JSON-RPC requests are tagged by "method", which selects the params type
+class _JSONRPCRequestBase(msgspec.Struct, kw_only=True, tag_field="method"):
     jsonrpc: Literal["2.0"]
     id: str
-    method: Literal["message/send", "execute"]
-    params: MessageParams | ExecuteParams
 
 
-class TaskStatus(BaseModel):
+class MessageSendRequest(_JSONRPCRequestBase, tag="message/send"):
+    params: MessageParams
+
+
+class ExecuteRequest(_JSONRPCRequestBase, tag="execute"):
+    params: ExecuteParams
+
+
+JSONRPCRequest = Union[MessageSendRequest, ExecuteRequest]
+
+
+class TaskStatus(msgspec.Struct, kw_only=True):
     state: Literal["working", "completed", "input-required", "failed"]
-    timestamp: str = Field(default_factory=lambda: datetime.utcnow().isoformat())
+    timestamp: str = msgspec.field(default_factory=lambda: datetime.utcnow().isoformat())
     message: Optional[A2AMessage] = None
 
 
-class Artifact(BaseModel):
-    artifactId: str = Field(default_factory=lambda: str(uuid4()))
+class Artifact(msgspec.Struct, kw_only=True):
+    artifactId: str = msgspec.field(default_factory=lambda: str(uuid4()))
     name: str
     parts: List[MessagePart]
 
 
-class TaskResult(BaseModel):
+class TaskResult(msgspec.Struct, kw_only=True):
     id: str
     contextId: str
     status: TaskStatus
-    artifacts: List[Artifact] = []
-    history: List[A2AMessage] = []
+    artifacts: List[Artifact] = msgspec.field(default_factory=list)
+    history: List[A2AMessage] = msgspec.field(default_factory=list)
     kind: Literal["task"] = "task"
 
 
-class JSONRPCResponse(BaseModel):
+class JSONRPCResponse(msgspec.Struct, kw_only=True):
     jsonrpc: Literal["2.0"] = "2.0"
     id: str
     result: Optional[TaskResult] = None
-    error: Optional[Dict[str, Any]] = None
\ No newline at end of file
+    error: Optional[Dict[str, Any]] = None
+
+
+encoder = msgspec.json.Encoder()
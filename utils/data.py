@@ -43,4 +43,13 @@ Choice:
 Conclude with which entity performs better overall and briefly justify why.
 """
 
-system_prompt += output_format
\ No newline at end of file
+system_prompt += output_format
+
+non_comparison_message = (
+    "This AI Agent is designed only for comparing two companies.\n\n"
+    "Example inputs:\n"
+    "- Compare Apple and Microsoft\n"
+    "- How does Tesla compare to Ford?\n"
+    "- Which is better, Google or Amazon?\n\n"
+    "Please rephrase your request to include two companies for comparison."
+)
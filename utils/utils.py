@@ -1,10 +1,105 @@
-import yfinance as yf
+from yfinance.data import YfData
+from cachetools import TTLCache
+from curl_cffi import requests as curl_requests
 from utils.data import compare_companies_json
-import json
+import asyncio
+import orjson
 import re
+import threading
 
+INFO_CACHE_TTL = 600  # seconds
+INFO_CACHE_MAXSIZE = 1024
 
-def compare_companies(ticker1: str, ticker2: str) -> dict:
+# Symbol looked up at startup to complete Yahoo's cookie/crumb handshake
+WARM_UP_SYMBOL = "AAPL"
+
+# Shared keep-alive session so repeated lookups reuse the TCP/TLS connection
+# to Yahoo. yfinance requires a curl_cffi session rather than requests.Session.
+_SESSION = curl_requests.Session(impersonate="chrome")
+
+# yfinance's request layer handles Yahoo's cookie/crumb authentication
+_YF_DATA = YfData(session=_SESSION)
+
+# quoteSummary modules holding the metrics below; far smaller than the full
+# `.info` payload, which pulls several more modules plus a second quote request
+_QUOTE_SUMMARY_URL = "https://query2.finance.yahoo.com/v10/finance/quoteSummary/{}"
+_QUOTE_SUMMARY_MODULES = "price,summaryProfile,summaryDetail,financialData,defaultKeyStatistics"
+
+metrics = [
+    "shortName", "sector", "marketCap", "currentPrice",
+    "revenueGrowth", "grossMargins", "profitMargins",
+    "trailingPE", "dividendYield"
+]
+
+# Ticker info by normalized symbol. Lookups run in asyncio.to_thread workers,
+# so every access goes through _INFO_CACHE_LOCK.
+_INFO_CACHE: TTLCache = TTLCache(maxsize=INFO_CACHE_MAXSIZE, ttl=INFO_CACHE_TTL)
+_INFO_CACHE_LOCK = threading.Lock()
+
+
+def _get_info(ticker: str) -> dict:
+    """
+    Blocking Yahoo Finance lookup, run off the event loop via asyncio.to_thread.
+    Results are cached per ticker for INFO_CACHE_TTL seconds.
+    """
+    key = ticker.strip().upper()
+
+    with _INFO_CACHE_LOCK:
+        cached = _INFO_CACHE.get(key)
+    if cached is not None:
+        return cached
+
+    # Fetch outside the lock so lookups for other tickers aren't serialized
+    info = _fetch_metrics(key)
+
+    # Only cache successful lookups so a bad symbol can be retried
+    if info and "shortName" in info:
+        with _INFO_CACHE_LOCK:
+            _INFO_CACHE[key] = info
+
+    return info
+
+
+def warm_up_session() -> None:
+    """
+    Look up WARM_UP_SYMBOL through _YF_DATA so yfinance fetches and caches
+    Yahoo's cookie and crumb before the first real request.
+
+    The cookie and crumb live on the shared YfData instance and are reused by
+    every worker thread. The connection itself is not: curl_cffi keeps one
+    curl handle per thread, so lookups on other threads still open their own.
+    """
+    _get_info(WARM_UP_SYMBOL)
+
+
+def _fetch_metrics(ticker: str) -> dict:
+    """Fetch just the compared metrics for a ticker from Yahoo's quoteSummary endpoint"""
+    response = _YF_DATA.get(
+        _QUOTE_SUMMARY_URL.format(ticker),
+        params={
+            "modules": _QUOTE_SUMMARY_MODULES,
+            "formatted": "false",
+            "corsDomain": "finance.yahoo.com",
+            "symbol": ticker
+        }
+    )
+    if response.status_code != 200:
+        return {}
+
+    result = (orjson.loads(response.content).get("quoteSummary") or {}).get("result")
+    if not result:
+        return {}
+
+    # Modules are flat dicts of raw values; missing values come back as {}
+    info = {}
+    for module in result[0].values():
+        if isinstance(module, dict):
+            info.update(module)
+
+    return {m: info[m] for m in metrics if info.get(m) not in (None, {})}
+
+
+async def compare_companies(ticker1: str, ticker2: str) -> dict:
     """
     Compare two companies' financial performance using Yahoo Finance data.
     """
@@ -12,20 +107,17 @@ def compare_companies(ticker1: str, ticker2: str) -> dict:
         if not ticker1 or not ticker2:
             return {"error": "Both ticker symbols must be provided."}
 
-        c1 = yf.Ticker(ticker1).info
-        c2 = yf.Ticker(ticker2).info
+        # Both lookups are independent network calls, so run them concurrently
+        c1, c2 = await asyncio.gather(
+            asyncio.to_thread(_get_info, ticker1),
+            asyncio.to_thread(_get_info, ticker2)
+        )
 
         if not c1 or "shortName" not in c1:
             return {"error": f"Could not retrieve data for '{ticker1}'. Please check the ticker symbol."}
         if not c2 or "shortName" not in c2:
             return {"error": f"Could not retrieve data for '{ticker2}'. Please check the ticker symbol."}
 
-        metrics = [
-            "shortName", "sector", "marketCap", "currentPrice",
-            "revenueGrowth", "grossMargins", "profitMargins",
-            "trailingPE", "dividendYield"
-        ]
-
         company1_data = {m: c1.get(m, "N/A") for m in metrics}
         company2_data = {m: c2.get(m, "N/A") for m in metrics}
 
@@ -52,47 +144,120 @@ tools = [
     {"type": "function", "function": compare_companies_json}
 ]
 
+# The only functions the model may call, by tool name
+_TOOLS = {
+    "compare_companies": compare_companies
+}
+
 
-def handle_tool_calls(tool_calls):
-    """Handle tool calls from OpenAI"""
-    results = []
-    for tool_call in tool_calls:
-        tool_name = tool_call.function.name
-        arguments = json.loads(tool_call.function.arguments)
+async def handle_tool_calls(tool_calls):
+    """
+    Handle tool calls from OpenAI, given as assistant tool_call dicts.
 
-        tool = globals().get(tool_name)
-        result = tool(**arguments) if tool else {}
+    Returns:
+        tuple: (tool_messages, results)
+               tool_messages are the serialized "tool" messages for the LLM,
+               results are the raw tool return values in the same order
+    """
+    async def _run(tool_call):
+        tool_name = tool_call["function"]["name"]
+        arguments = orjson.loads(tool_call["function"]["arguments"] or "{}")
 
-        results.append({
+        tool = _TOOLS.get(tool_name)
+        if tool is None:
+            return {"error": f"Unknown tool '{tool_name}'."}
+        return await tool(**arguments)
+
+    # Independent tool calls run concurrently; gather keeps their order
+    results = await asyncio.gather(*(_run(tc) for tc in tool_calls))
+
+    messages = [
+        {
             "role": "tool",
-            "content": json.dumps(result),
-            "tool_call_id": tool_call.id
-        })
+            "content": orjson.dumps(result).decode(),
+            "tool_call_id": tool_call["id"]
+        }
+        for tool_call, result in zip(tool_calls, results)
+    ]
+
+    return messages, list(results)
 
-    return results
+
+# Single-word comparison cues, matched with one set lookup over the message's
+# words instead of a regex alternation scanned across the whole text
+comparison_keywords = frozenset({
+    "better", "worse", "compare", "comparing", "comparison",
+    "versus", "vs", "against", "between", "than",
+})
+
+# Multi-word cues that a keyword alone does not cover
+comparison_patterns = [
+    r"\bdifference\s+of\b",
+    r"\bwhich\s+(is|has|performs|does)\b.*\b(higher|lower|more|less)\b",
+    r"\b(is|are)\s+(higher|lower|more|less)\b",
+    r"\brelative\s+to\b",
+]
+
+# Compiled once at import; is_comparison_query runs on every request
+_WORD_RE = re.compile(r"\w+")
+_COMPARISON_RE = re.compile("|".join(comparison_patterns), re.IGNORECASE)
 
 
 def is_comparison_query(text: str) -> bool:
     """Detects whether a user's input is a comparison-type query."""
-    comparison_patterns = [
-        r"\bbetter\b",
-        r"\bworse\b",
-        r"\bcompare\b",
-        r"\bcomparing\b",
-        r"\bcomparison\b",
-        r"\bversus\b",
-        r"\bvs\b",
-        r"\bvs\.\b",
-        r"\bagainst\b",
-        r"\bbetween\b",
-        r"\bdifference\s+(between|of)\b",
-        r"\bhow\s+does\b.*\bcompare\b.*\bto\b",
-        r"\bhow\s+do\b.*\bcompare\b",
-        r"\bwhich\s+(is|has|performs|does)\b.*\b(better|worse|higher|lower|more|less)\b",
-        r"\b(is|are)\s+(better|worse|higher|lower|more|less)\b",
-        r"\bthan\b",
-        r"\brelative\s+to\b",
-    ]
+    if not comparison_keywords.isdisjoint(_WORD_RE.findall(text.lower())):
+        return True
+    return _COMPARISON_RE.search(text) is not None
 
-    combined_pattern = "|".join(comparison_patterns)
-    return bool(re.search(combined_pattern, text, flags=re.IGNORECASE))
+
+_HTML_TAG_RE = re.compile(r'<[^>]+>')
+
+
+def clean_html(text: str) -> str:
+    """Remove HTML tags and extra whitespace from text"""
+    clean = _HTML_TAG_RE.sub('', text)
+    return ' '.join(clean.split())
+
+
+# Uppercase words that look like tickers but are ordinary words in a query
+_TICKER_STOPWORDS = frozenset({
+    "A", "I", "AM", "AN", "AND", "ARE", "AS", "AT", "BE", "BY", "DO", "FOR",
+    "HOW", "IF", "IN", "IS", "IT", "OF", "ON", "OR", "THE", "TO", "VS", "WHO",
+    "CEO", "CFO", "EPS", "ETF", "IPO", "PE", "ROI", "USD", "US", "UK", "EU",
+})
+_TICKER_RE = re.compile(r"\b[A-Z]{1,5}\b")
+
+
+def extract_tickers(text: str) -> list[str]:
+    """Returns the distinct ticker-like tokens in a message, in order of appearance."""
+    tickers = []
+    for token in _TICKER_RE.findall(text):
+        if token not in _TICKER_STOPWORDS and token not in tickers:
+            tickers.append(token)
+    return tickers
+
+
+# Whole messages that are nothing but a comparison of two tickers, e.g.
+# "Compare AAPL and MSFT", "AAPL vs. MSFT?", "How does TSLA compare to F?".
+# Cue words match in any case, tickers only in uppercase.
+_TICKER = r"([A-Z]{1,5})"
+_TICKER_PAIR_RES = [
+    re.compile(rf"(?i:compare\s+)?{_TICKER}\s+(?i:vs\.?|versus|and|against|with|to)\s+{_TICKER}"),
+    re.compile(rf"(?i:how\s+do(?:es)?\s+){_TICKER}\s+(?i:compare\s+(?:to|with|against))\s+{_TICKER}"),
+]
+
+
+def explicit_ticker_pair(text: str) -> tuple[str, str] | None:
+    """
+    Returns the two tickers when the whole message is a plain comparison of
+    two ticker symbols, otherwise None. Unlike extract_tickers this never
+    picks up other uppercase words in a longer question ("R and D", "EV").
+    """
+    text = text.strip().rstrip("?.! ")
+    for pattern in _TICKER_PAIR_RES:
+        match = pattern.fullmatch(text)
+        if match:
+            first, second = match.groups()
+            if first != second and first not in _TICKER_STOPWORDS and second not in _TICKER_STOPWORDS:
+                return first, second
+    return None